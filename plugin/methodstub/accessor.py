@@ -1,6 +1,6 @@
 import os
+import re
 import sys
-import collections
 
 import clang.cindex
 from clang.cindex import CursorKind
@@ -9,6 +9,10 @@ import vim
 
 import methodstub
 
+_ident_start_re = re.compile(r'[A-Za-z_]')
+
+_field_kinds = frozenset([CursorKind.FIELD_DECL])
+
 class GenerationSettings(object):
     def __init__(self, make_getter, make_setter):
         self.make_getter = make_getter
@@ -18,52 +22,39 @@ class AccessorKind(object):
     GETTER = 0
     SETTER = 1
 
-def is_field_cursor(cursor):
-    return cursor.kind == CursorKind.FIELD_DECL
-
 def get_method_name_from_field(field_name):
-    method_name = ''
-    if field_name.find('m_') == 0:
+    method_name = field_name
+    if field_name.startswith('m_'):
         method_name = field_name[2:]
-    elif field_name.find('_') == 0:
+    elif field_name.startswith('_'):
         method_name = field_name[1:]
-    elif field_name.rfind('_') == len(field_name) - 1:
-        method_name = field_name[:len(field_name)-1]
-    #If underscore_delimited_words
-    method_name = ''.join([word.title() for word in method_name.split('_')])
-    method_name = method_name.title()
+    elif field_name.endswith('_'):
+        method_name = field_name[:-1]
+    #If underscore_delimited_words, capitalise only the first letter of
+    #each word so camelCase names keep their inner capitals
+    method_name = ''.join([word[:1].upper() + word[1:] \
+            for word in method_name.split('_')])
     return method_name
 
 def make_fn_decl(tu, field_cursor, kind):
-    type = field_cursor.type
-    type_name = methodstub.format_type_name(type.spelling)
-    method_name = collections.deque()
-    method_name.append(get_method_name_from_field(field_cursor.spelling))
+    type_name = methodstub.format_type_name(field_cursor.type.spelling)
+    method_name = get_method_name_from_field(field_cursor.spelling)
     if kind == AccessorKind.GETTER:
-        method_name.appendleft('get')
-        method_name.append('() const')
-    else:
-        method_name.appendleft('set')
-        method_name.append('({0} value)'.format(type_name))
-    method_name.appendleft(type_name + ' ')
-    return ''.join(method_name)
+        return '{0} get{1}() const'.format(type_name, method_name)
+    return '{0} set{1}({0} value)'.format(type_name, method_name)
 
 
 
 def get_field_cursor_from_location(tu, location):
     cursor = methodstub.get_cursor_from_location(tu, location)
-    while cursor is not None:
-        if is_field_cursor(cursor):
-            return cursor
-        cursor = cursor.semantic_parent
-    return None
+    return methodstub.find_enclosing_cursor(cursor, _field_kinds, \
+            semantic=True)
 
 def find_field_name_from_line(str):
-    for i, ch in enumerate(str):
-        if (ch >= 'a' and ch <= 'z') or (ch >= 'A' and ch <= 'Z') \
-                or ch == '_':
-            return i + 1
-    return None
+    match = _ident_start_re.search(str)
+    if match is None:
+        return None
+    return match.start() + 1
 
 def get_field_cursor_on_line(tu, location, buffer):
     cursor = get_field_cursor_from_location(tu, location)
@@ -91,8 +82,7 @@ def generate_under_cursor(inline=True, getter=True, setter=False):
 
     unsaved_data = methodstub.build_unsaved_data([files.header, files.source])
 
-    index = clang.cindex.Index.create()
-    tu = methodstub.create_translation_unit(index, files.output, unsaved_data)
+    tu = methodstub.get_translation_unit(files, unsaved_data)
 
     _, line, col, _ = vim.eval("getpos('.')")
     line = int(line)
@@ -1,6 +1,8 @@
 import os
+import re
 import sys
 import collections
+import linecache
 
 import clang.cindex
 from clang.cindex import CursorKind
@@ -14,81 +16,76 @@ flags = [
     '-fno-color-diagnostics'
         ]
 
-class InsertionBlock(object):
-    def __init__(self, key, length, line):
-        self.key = key
-        self.length = length
-        self.line = line
-
-    def __repr__(self):
-        return '<InsertionBlock: {0} {1} {2}>'.format(self.key, self.length, \
-                self.line)
-
-class InsertionTracker(object):
-    def __init__(self):
-        self._insertions = []
-        self._blocks = {}
-
-    def __str__(self):
-        str = []
-        for blocks in self._insertions:
-            str.append('{0}: {1}'.format(blocks[0].line, blocks))
-        return '\n'.join(str)
-
-    def insert_block(self, after_line, key, length):
-        block = InsertionBlock(key, length, after_line)
-        index = self._find_line_index(after_line)
-        if len(self._insertions) > index and self._insertions[index][0].line == after_line:
-            self._insertions[index].append(block)
-        else:
-            self._insertions.insert(index, collections.deque([block]))
-
-        self._blocks[key] = (after_line, block)
-
-    def map_line_number(self, old_number):
-        new_num = old_number
-        for blocks in self._insertions:
-            line = blocks[0].line
-            if line > old_number:
-                break
-            new_num += sum([block.length for block in blocks])
-        return new_num
-
-    def __contains__(self, key):
-        return key in self._blocks 
-
-    def get_block_insertion_line(self, key):
-        if key in self._blocks:
-            return self._blocks[key].line
-        return None
-
-    def get_block_line_number(self, key):
-        if key not in self._blocks:
-            return None
-        block = self._blocks[key]
-        start_line = self.map_line_number(block.line)
-        block_list = self._insertions[self._find_line_index(block.line)]
-        line = start_line
-        for block2 in block_list:
-            if block == block2:
-                break
-            line += block.length
-        return line
-
-    def _find_line_index(self, line):
-        max_index = len(self._insertions)
-        min_index = 0
-
-        while min_index < max_index:
-            mid = (max_index + min_index) / 2
-            if self._insertions[mid][0].line == line:
-                return mid
-            elif self._insertions[mid][0].line < line:
-                min_index = mid + 1
-            else:
-                max_index = mid - 1
-        return len(self._insertions)
-
+#In order of preference when looking for a corresponding file
+header_extensions = ('.hpp', '.hxx', '.h')
+source_extensions = ('.cpp', '.cxx', '.c')
+
+#Only declarations are needed, so skip bodies and the template
+#instantiation done at the end of a complete translation unit
+parse_options = clang.cindex.TranslationUnit.PARSE_PRECOMPILED_PREAMBLE | \
+        clang.cindex.TranslationUnit.PARSE_CACHE_COMPLETION_RESULTS | \
+        clang.cindex.TranslationUnit.PARSE_SKIP_FUNCTION_BODIES | \
+        clang.cindex.TranslationUnit.PARSE_INCOMPLETE
+
+_index = None
+#Each translation unit holds its preamble and a copy of the unsaved
+#buffers, so only keep the most recently used few
+_max_translation_units = 2
+_translation_units = collections.OrderedDict()
+
+_bracket_re = re.compile(r'[(){}]')
+
+_pointer_space_re = re.compile(r' +([*&])')
+
+#Comments and literals are matched so that words inside them are skipped
+_token_re = re.compile(r'//[^\n]*|/\*.*?\*/|"(?:\\.|[^"\\\n])*"|' \
+        r"'(?:\\.|[^'\\\n])*'|[A-Za-z_]\w*|[(){;]", re.S)
+
+_function_kinds = frozenset([
+    CursorKind.FUNCTION_DECL,
+    CursorKind.FUNCTION_TEMPLATE,
+    CursorKind.CXX_METHOD,
+    CursorKind.DESTRUCTOR,
+    CursorKind.CONSTRUCTOR
+        ])
+
+#Functions that are declared without a return type
+_structor_kinds = frozenset([
+    CursorKind.CONSTRUCTOR,
+    CursorKind.DESTRUCTOR
+        ])
+
+_class_kinds = frozenset([
+    CursorKind.CLASS_DECL,
+    CursorKind.CLASS_TEMPLATE
+        ])
+
+#Not exposed by older clang.cindex bindings, where friend functions
+#are then treated like any other function
+_friend_kind = getattr(CursorKind, 'FRIEND_DECL', None)
+
+#Every kind of declaration that can have member functions
+_record_kinds = frozenset([
+    CursorKind.CLASS_DECL,
+    CursorKind.STRUCT_DECL,
+    CursorKind.UNION_DECL,
+    CursorKind.CLASS_TEMPLATE,
+    CursorKind.CLASS_TEMPLATE_PARTIAL_SPECIALIZATION
+        ])
+
+_canonical_hash_cache = {}
+_semantic_parents_cache = {}
+_parameters_cache = {}
+_enclosing_cursor_cache = {}
+_member_class_name_cache = {}
+
+_fileset_cache = {}
+
+_buffers_by_name = {}
+_buffer_list_state = None
+
+_buffer_text_cache = {}
+_endif_line_cache = {}
 
 class FileSet(object):
     '''Provides a single object to store all file information.'''
@@ -104,102 +101,183 @@ class FileSet(object):
     def is_output_header(self):
         return self.header == self.output
 
-class Traverser(object):
-    '''Defined an interface for classes that need to traverse the AST.'''
-    def __init__(self):
-        self._output = None 
-    
-    def traverse(self, cursor):
-        self._start_traversal(cursor)
-        output = self._get_output()
-        self._output = None
-        return output 
-
-    def _traversal_fn(self, cursor, parent):
-        raise NotImplementedError
-
-    def _start_traversal(self, cursor):
-        iterate_cursor(cursor, self._traversal_fn)
-
-    def _get_output(self):
-        return self._output
-
-class NamespaceTraverser(Traverser):
-    '''Traverser that generates a list of namespace
-       cursors containing the given function.'''
-    def __init__(self, source_file, target_fn):
-        self._source_file = source_file
-        self._target_fn = target_fn
-        self._output = []
-
-    def _traversal_fn(self, cursor, parent):
-        if cursor.location is not None and cursor.location.file is not None:
-            if cursor.location.file.name == self._source_file:
-                if cursor.kind == CursorKind.NAMESPACE:
-                    parent = self._target_fn.semantic_parent
-                    while parent is not None:
-                        if parent.canonical == cursor.canonical:
-                            self._output.append(cursor)
-                            break
-                        parent = parent.semantic_parent
-                    return True
-            else:
-                return False
-        return True
-
-class FollowingFunctionTraverser(Traverser):
-    '''Traverser that generates a list of all function declarations
-       occuring after the given declaration in the same scope.'''
-    def __init__(self, source_file, find_fn):
-        self._source_file = source_file
-        self._find_fn = find_fn
-        self._found_fn = False
-        self._output = []
-
-    def _traversal_fn(self, cursor, parent):
-        if cursor.location.file is not None:
-            if cursor.location.file.name == self._source_file:
-                if is_cursor_function(cursor) and cursor.lexical_parent.canonical == \
-                        self._find_fn.lexical_parent.canonical and self._found_fn:
-                    self._output.append(cursor)
-                if self._find_fn.canonical == cursor.canonical:
-                    self._found_fn = True
-            else:
+def traverse_stub_context(root, output_file, header_file, target_fn):
+    '''Gather everything needed to place a definition for target_fn in a
+       single traversal from root. Returns a tuple of the function
+       definitions in the output file, the function declarations in the
+       header sharing the lexical parent of target_fn, in source order,
+       and the output file namespaces containing target_fn.'''
+    target_parent = get_canonical_hash(target_fn.semantic_parent)
+    target_lexical_parent = get_canonical_hash(target_fn.lexical_parent)
+    target_scopes = set([get_canonical_hash(parent) \
+            for parent in get_semantic_parents(target_fn)])
+    #A friend function is declared in a class that is not one of its
+    #semantic parents, so also allow the classes lexically enclosing it
+    record_scopes = set(target_scopes)
+    parent = target_fn.lexical_parent
+    while parent is not None:
+        record_scopes.add(get_canonical_hash(parent))
+        parent = parent.lexical_parent
+    definitions = {}
+    siblings = []
+    namespaces = []
+
+    #Globals are bound as default arguments so they are local lookups
+    def visit(cursor, parent, file_name, function_kinds=_function_kinds, \
+            namespace_kind=CursorKind.NAMESPACE, \
+            friend_kind=_friend_kind, \
+            record_kinds=_record_kinds, canonical_hash=get_canonical_hash):
+        if file_name is None:
+            return True
+        kind = cursor.kind
+        if kind == namespace_kind:
+            #Declarations and definitions of target_fn and its neighbours
+            #can only be inside the namespaces enclosing it
+            if canonical_hash(cursor) not in target_scopes:
                 return False
-        return True
-
-class DefinitionTraverser(Traverser):
-    '''Traverser that finds all function definitions in a file.'''
-    def __init__(self, source_file, find_fn):
-        self._source_file = source_file
-        self._find_fn = find_fn
-        self._find_fn_parent = find_fn.semantic_parent.canonical
-        self._output = {}
-
-    def _traversal_fn(self, cursor, parent):
-        if cursor.location is not None and cursor.location.file is not None:
-            if cursor.location.file.name == self._source_file:
-                #Avoid functions that are within the lexical scope of the class
-                #(so function declarations or inline definitions)
-                if is_cursor_function(cursor) and \
-                        cursor.lexical_parent.canonical != self._find_fn_parent:
-                    name = cursor.spelling
-                    if name in self._output:
-                        self._output[name].append(cursor)
-                    else:
-                        self._output[name] = [cursor]
+            if file_name == output_file:
+                namespaces.append(cursor)
+            return True
+        if kind in record_kinds:
+            #Outside the output file only the classes enclosing target_fn,
+            #or declaring it as a friend, can hold the declarations
+            #following it
+            if file_name == output_file:
+                return True
+            return canonical_hash(cursor) in record_scopes
+        if kind not in function_kinds:
+            return True
+
+        #The walk visits lexical children, so parent is the lexical parent,
+        #except for friend functions which are nested in a FRIEND_DECL.
+        #Comparing canonical parents includes reopened namespace blocks.
+        if parent.kind == friend_kind:
+            parent_hash = canonical_hash(cursor.lexical_parent)
+        else:
+            parent_hash = canonical_hash(parent)
+        if file_name == header_file and parent_hash == target_lexical_parent:
+            siblings.append(cursor)
+        #Avoid functions that are within the lexical scope of the class
+        #(so function declarations or inline definitions)
+        if file_name == output_file and parent_hash != target_parent:
+            name = cursor.spelling
+            if name in definitions:
+                definitions[name].append(cursor)
             else:
-                return False
-        return True
+                definitions[name] = [cursor]
+        #Nothing we look for is nested inside a function
+        return False
+
+    iterate_user_cursors(root, visit, set([output_file, header_file]))
+    return (definitions, siblings, namespaces)
 
 def create_translation_unit(index, source, unsaved_data=[]):
     '''Build a translation unit by parsing the file source using
        index index with unsaved_data containing a list of(name, data) tuples
        with the full content of any unsaved buffers.'''
-    return index.parse(None, [source] + flags, \
-            unsaved_data, \
-            clang.cindex.TranslationUnit.PARSE_SKIP_FUNCTION_BODIES)
-
+    clear_cursor_caches()
+    return index.parse(None, [source] + flags, unsaved_data, parse_options)
+
+def get_translation_unit(files, unsaved_data):
+    '''Return a translation unit for files.output. The translation unit
+       from an earlier call for the same file is reused as is if none of
+       its files or unsaved buffers have changed since, and reparsed
+       otherwise, so its precompiled preamble is reused.'''
+    cached = _translation_units.pop(files.output, None)
+    if cached is not None:
+        tu, tu_files, state, _ = cached
+        #Cursor caches may hold hashes from another translation unit
+        clear_cursor_caches()
+        if get_source_state(tu_files, unsaved_data) == state:
+            _translation_units[files.output] = cached
+            return tu
+        tu.reparse(unsaved_data)
+    else:
+        tu = create_translation_unit(get_index(), files.output, unsaved_data)
+
+    #Headers pulled in by system headers are not going to change between
+    #invocations, so don't stat them every time. Older clang.cindex
+    #bindings can't tell, in which case every header is checked.
+    tu_files = set([files.output])
+    for include in tu.get_includes():
+        if not getattr(include.location, 'is_in_system_header', False):
+            tu_files.add(os.path.abspath(include.include.name))
+    tu_files = sorted(tu_files)
+    #Scope contexts found by find_stub_context hold cursors into the
+    #previous parse, so start over with an empty scope cache
+    _translation_units[files.output] = \
+            (tu, tu_files, get_source_state(tu_files, unsaved_data), {})
+    while len(_translation_units) > _max_translation_units:
+        _translation_units.popitem(last=False)
+    return tu
+
+def forget_translation_units(path):
+    '''Drop cached translation units that include the file path. Called
+       from vim when the buffer for path is deleted.'''
+    path = os.path.abspath(path)
+    for output, cached in list(_translation_units.items()):
+        if path in cached[1]:
+            del _translation_units[output]
+
+def get_scope_cache(files):
+    '''Return the scope cache for find_stub_context kept alongside the
+       translation unit of files.output, so scopes traversed by earlier
+       calls are reused for as long as the translation unit is.'''
+    return _translation_units[files.output][3]
+
+def get_source_state(file_names, unsaved_data):
+    '''Return a value that changes whenever one of file_names is
+       modified on disk or the unsaved buffer contents change.'''
+    mtimes = []
+    for file_name in file_names:
+        try:
+            mtimes.append(os.path.getmtime(file_name))
+        except OSError:
+            mtimes.append(None)
+    return (mtimes, unsaved_data)
+
+def get_index():
+    '''Return the clang Index shared by every invocation, creating it
+       on first use.'''
+    global _index
+    if _index is None:
+        _index = clang.cindex.Index.create()
+    return _index
+
+
+def clear_cursor_caches():
+    '''Forget all memoized cursor properties. Cursor hashes are only
+       meaningful within a single translation unit.'''
+    _canonical_hash_cache.clear()
+    _semantic_parents_cache.clear()
+    _parameters_cache.clear()
+    _enclosing_cursor_cache.clear()
+    _member_class_name_cache.clear()
+
+def get_canonical_hash(cursor):
+    '''Return the hash of the canonical cursor for cursor, memoized
+       on the hash of cursor itself.'''
+    key = cursor.hash
+    value = _canonical_hash_cache.get(key)
+    if value is None:
+        value = cursor.canonical.hash
+        _canonical_hash_cache[key] = value
+    return value
+
+def get_semantic_parents(cursor):
+    '''Return a tuple of the semantic parents of cursor, innermost
+       first, memoized on the hash of cursor.'''
+    key = cursor.hash
+    parents = _semantic_parents_cache.get(key)
+    if parents is None:
+        parents = []
+        parent = cursor.semantic_parent
+        while parent is not None:
+            parents.append(parent)
+            parent = parent.semantic_parent
+        parents = tuple(parents)
+        _semantic_parents_cache[key] = parents
+    return parents
 
 def get_cursor_from_location(tu, location):
     '''Return a cursor at the given location in the given translation unit.'''
@@ -211,9 +289,7 @@ def get_corresponding_file(file_name, extensions):
        in the list of extensions provided. A name will be returned
        if there is a file on the disk or an open buffer with an appropriate
        name, otherwise None will be returned.'''
-    file = file_name.split('.')
-    ext = file[len(file)-1]
-    file = '.'.join(file[:len(file)-1])
+    file, ext = os.path.splitext(file_name)
 
     #If file_name already has a correct extension, just return it
     if ext in extensions:
@@ -223,7 +299,7 @@ def get_corresponding_file(file_name, extensions):
     else:
         for new_ext in extensions:
             new_file = file + new_ext
-            if get_buffer_with_name(new_file) or \
+            if get_buffer_with_name(new_file) is not None or \
                     os.path.exists(new_file):
                 return new_file
         return None
@@ -231,42 +307,71 @@ def get_corresponding_file(file_name, extensions):
 def get_header_file(file_name):
     '''Return a corresponding file with an extension of
        .hpp, .hxx or .h'''
-    header_ext = ['.hpp', '.hxx', '.h']
-    return get_corresponding_file(file_name, header_ext)
+    return get_corresponding_file(file_name, header_extensions)
 def get_source_file(file_name):
     '''Return a corresponding file with an extension of
        .cpp, .cxx or .c'''
-    source_ext = ['.cpp', '.cxx', '.c']
-    return get_corresponding_file(file_name, source_ext)
+    return get_corresponding_file(file_name, source_extensions)
 
 def get_buffer_with_name(name):
     '''Return an open buffer with the name name, or none
-       if no such buffer exists.'''
-    for buf in vim.buffers:
-        if buf.name == name:
-            return buf
-
-def is_cursor_function(cursor):
-    '''Return whether the provided cursor is some sort of function.'''
-    if cursor.kind == CursorKind.FUNCTION_DECL or \
-            cursor.kind == CursorKind.FUNCTION_TEMPLATE or \
-            cursor.kind == CursorKind.CXX_METHOD or \
-            cursor.kind == CursorKind.DESTRUCTOR or \
-            cursor.kind == CursorKind.CONSTRUCTOR:
-        return True
-    return False
+       if no such buffer exists. The name lookup table is rebuilt
+       after invalidate_buffer_index or when the number of buffers
+       changes.'''
+    global _buffer_list_state
+    state = len(vim.buffers)
+    if state != _buffer_list_state:
+        _buffers_by_name.clear()
+        numbers = set()
+        for buf in vim.buffers:
+            numbers.add(buf.number)
+            if buf.name:
+                _buffers_by_name[os.path.normpath(buf.name)] = buf
+        _buffer_list_state = state
+        #Don't hold on to the text of buffers that have been wiped
+        for number in list(_buffer_text_cache):
+            if number not in numbers:
+                del _buffer_text_cache[number]
+    return _buffers_by_name.get(os.path.normpath(name))
+
+def invalidate_buffer_index():
+    '''Rebuild the buffer name lookup table on the next call to
+       get_buffer_with_name. Called from vim when a buffer is added,
+       renamed or wiped.'''
+    global _buffer_list_state
+    _buffer_list_state = None
+
+def find_enclosing_cursor(cursor, kinds, semantic=False):
+    '''Return the first cursor with a kind in kinds found by walking up
+       the lexical (or semantic) parents of cursor, starting from cursor
+       itself. The walk stops if a cursor repeats, and results are
+       memoized on the hash of cursor.'''
+    if cursor is None:
+        return None
+    key = (cursor.hash, kinds, semantic)
+    if key in _enclosing_cursor_cache:
+        return _enclosing_cursor_cache[key]
+
+    found = None
+    seen = set()
+    cur = cursor
+    while cur is not None and cur.hash not in seen:
+        if cur.kind in kinds:
+            found = cur
+            break
+        seen.add(cur.hash)
+        if semantic:
+            cur = cur.semantic_parent
+        else:
+            cur = cur.lexical_parent
+    _enclosing_cursor_cache[key] = found
+    return found
 
 def get_function_cursor_from_location(tu, location):
     '''Return a cursor at the current location that is a function,
        if one exists.'''
     cursor = get_cursor_from_location(tu, location)
-
-    while cursor is not None:
-        if is_cursor_function(cursor):
-            break
-        else:
-            cursor = cursor.lexical_parent
-    return cursor
+    return find_enclosing_cursor(cursor, _function_kinds)
 
 def error(str):
     '''Output an error message.'''
@@ -275,51 +380,82 @@ def error(str):
 def iterate_cursor(cursor, fn, parent=None):
     '''Iterate all children of cursor, calling fn for each.
        fn may return False to stop recursion into that node's children.'''
-    ret = fn(cursor, parent)
-    if ret is True:
-        for child in cursor.get_children():
-            iterate_cursor(child, fn, cursor)
+    if fn(cursor, parent) is not True:
+        return
+    #Keep a child iterator for each level of the walk, like a tree cursor
+    stack = [(cursor, cursor.get_children())]
+    while stack:
+        cur, children = stack[-1]
+        for child in children:
+            if fn(child, cur) is True:
+                stack.append((child, child.get_children()))
+                break
+        else:
+            stack.pop()
+
+def iterate_user_cursors(cursor, fn, user_files, parent=None):
+    '''Iterate cursor and its children like iterate_cursor, skipping any
+       cursor located in a file outside the set user_files without visiting
+       its children. Cursors below the root that have no file, such as
+       builtin declarations, are skipped too. fn is called with the cursor,
+       its parent and the name of the file containing it, which is None
+       for the root if it has no file.'''
+    def visit(cur, par):
+        file = cur.location.file
+        if file is None:
+            if cur is not cursor:
+                return False
+            return fn(cur, par, None)
+        file_name = file.name
+        if file_name not in user_files:
+            return False
+        return fn(cur, par, file_name)
+    iterate_cursor(cursor, visit, parent)
 
 def format_type_name(old_name):
     '''Reformat a type name to remove the space
        between the type and * or &.'''
-    new_name = old_name
-    for i in range(len(old_name)):
-        ch = old_name[i]
-        if ch == '*' or ch == '&':
-            if i > 0 and old_name[i-1] == ' ':
-                new_name = new_name[:i-1] + new_name[i:]
-                break
-    return new_name
+    return _pointer_space_re.sub(r'\1', old_name)
+
+def get_parameters(cursor):
+    '''Return a tuple of (argument cursors, template argument names) for
+       cursor, collected in a single pass over its children and memoized
+       on the hash of cursor.'''
+    key = cursor.hash
+    parameters = _parameters_cache.get(key)
+    if parameters is None:
+        args = []
+        template_args = []
+        #get_args is exposed by clang, but in some rare circumstances wasn't
+        #returning arguments that existed, so we do it manually
+        for child in cursor.get_children():
+            kind = child.kind
+            if kind == CursorKind.PARM_DECL:
+                args.append(child)
+            elif kind == CursorKind.TEMPLATE_TYPE_PARAMETER:
+                template_args.append(child.spelling)
+        parameters = (args, template_args)
+        _parameters_cache[key] = parameters
+    return parameters
 
 def get_args_list(fn_cursor, strip_namespaces=[]):
     '''Return a string of arguments to the function fn_cursor'''
     arg_string = []
 
-    #get_args is exposed by clang, but in some rare circumstances wasn't
-    #returning arguments that existed, so we do it manually
-    for child in fn_cursor.get_children():
-        if child.kind == CursorKind.PARM_DECL:
-            arg_fragments = []
-            type_name = format_type_name(child.type.spelling)
-            arg_fragments.append(type_name)
-            name = child.spelling
-            type_name = strip_type_namespaces(type_name, strip_namespaces) 
-            if name != '':
-                arg_fragments.append(name)
-            arg_string.append(' '.join(arg_fragments))
+    for child in get_parameters(fn_cursor)[0]:
+        type_name = format_type_name(child.type.spelling)
+        name = child.spelling
+        if name != '':
+            arg_string.append(type_name + ' ' + name)
+        else:
+            arg_string.append(type_name)
 
     return ', '.join(arg_string)
 
 def get_template_args(cursor):
     '''Return a list of the names of each template argument
        to cursor. Cursor can be a function or class.'''
-    template_args = []
-    for child in cursor.get_children():
-        if child.kind == CursorKind.TEMPLATE_TYPE_PARAMETER:
-            template_args.append(child.spelling)
-
-    return template_args
+    return get_parameters(cursor)[1]
 
 
 def get_template_declaration(cursor):
@@ -336,21 +472,26 @@ def get_template_declaration(cursor):
 def get_member_class_name(cursor):
     '''Return the full scope string for the parent class or
         classes of cursor.'''
-    cur = cursor.semantic_parent
-    name = []
-    while cur is not None:
-        if cur.kind == CursorKind.CLASS_DECL or \
-            cur.kind == CursorKind.CLASS_TEMPLATE:
-            name.append(cur.spelling)
-        cur = cur.semantic_parent
+    #Every member of a class shares the same answer, so memoize on the
+    #hash of the semantic parent rather than of cursor itself.
+    parent = cursor.semantic_parent
+    if parent is None:
+        return None
+    key = parent.hash
+    if key in _member_class_name_cache:
+        return _member_class_name_cache[key]
+
+    name = [cur.spelling for cur in get_semantic_parents(cursor) \
+            if cur.kind in _class_kinds]
 
     out_string = None
     if len(name) > 0:
         out_string = '::'.join(name)
-        template_args = get_template_args(cursor.semantic_parent)
+        template_args = get_template_args(parent)
         if len(template_args) > 0:
-            out_string += '<{0}>'.format(', '.join(template_args))
+            out_string += '<' + ', '.join(template_args) + '>'
 
+    _member_class_name_cache[key] = out_string
     return out_string
 
 def strip_template_args(fn_name):
@@ -360,20 +501,52 @@ def strip_template_args(fn_name):
     if start == -1:
         return fn_name
     depth = 0
-    end = -1
-    for i in range(start, len(fn_name)):
-        ch = fn_name[i]
-        if ch == '<':
+    i = start
+    #Jump between angle brackets rather than stepping through every character
+    while True:
+        close_pos = fn_name.find('>', i)
+        if close_pos == -1:
+            return fn_name
+        open_pos = fn_name.find('<', i)
+        if open_pos != -1 and open_pos < close_pos:
             depth += 1
-        elif ch == '>':
+            i = open_pos + 1
+        else:
             depth -= 1
-        if depth == 0:
-            end = i
-            break
-    if end > 0:
-        return fn_name[:start] + fn_name[end+1:]
+            i = close_pos + 1
+            if depth == 0:
+                return fn_name[:start] + fn_name[i:]
+
+def get_extent_text(extent):
+    '''Return the source text covered by extent, read from an open buffer
+       when there is one so unsaved changes are seen, or None if the
+       extent has no file.'''
+    start = extent.start
+    end = extent.end
+    if start.file is None:
+        return None
+    file_name = start.file.name
+    buf = get_buffer_with_name(file_name)
+    if buf is not None:
+        lines = buf[start.line-1:end.line]
     else:
-        return fn_name
+        linecache.checkcache(file_name)
+        lines = [line.rstrip('\r\n') for line in \
+                linecache.getlines(file_name)[start.line-1:end.line]]
+    if len(lines) == 0:
+        return None
+    lines[-1] = lines[-1][:end.column-1]
+    lines[0] = lines[0][start.column-1:]
+    return '\n'.join(lines)
+
+def get_declaration_tokens(fn_cursor):
+    '''Return an iterable of the token spellings in the declaration of
+       fn_cursor. The source text is scanned directly where possible,
+       which avoids creating a libclang Token for every token.'''
+    text = get_extent_text(fn_cursor.extent)
+    if text is None:
+        return (t.spelling for t in fn_cursor.get_tokens())
+    return (match.group() for match in _token_re.finditer(text))
 
 def add_function_specifiers(fn_cursor, header):
     '''Find specifier keywords in the token stream and add them
@@ -381,23 +554,24 @@ def add_function_specifiers(fn_cursor, header):
     depth = 0
     name = fn_cursor.spelling
     found_fn = False
-    for t in fn_cursor.get_tokens():
-        if t.spelling == '{':
+    for token in get_declaration_tokens(fn_cursor):
+        #Stop at the body or at the end of the declaration
+        if token == '{' or (token == ';' and depth == 0):
             break
-        elif t.spelling == '(':
+        elif token == '(':
             depth += 1
-        elif t.spelling == ')':
+        elif token == ')':
             depth -= 1
-        elif t.spelling == name:
+        elif token == name:
             found_fn = True
         #Special case to handle overloaded operators
-        elif t.spelling == 'operator':
+        elif token == 'operator':
             found_fn = True
-        elif t.spelling == 'const' and depth == 0 and found_fn:
+        elif token == 'const' and depth == 0 and found_fn:
             header.append(' const')
-        elif t.spelling == 'noexcept' and depth == 0:
+        elif token == 'noexcept' and depth == 0:
             header.append(' noexcept')
-        elif t.spelling == 'constexpr' and depth == 0:
+        elif token == 'constexpr' and depth == 0:
             header.appendleft('constexpr ')
 
 def strip_type_namespaces(str, strip_namespaces):
@@ -432,14 +606,14 @@ def make_function_header(fn_cursor, inline=False, namespace='',
 
     class_name = get_member_class_name(fn_cursor)
     if class_name is not None and class_name != '':
-        fn_header.extend([class_name, "::"])
+        fn_header.append(class_name)
+        fn_header.append('::')
 
-    fn_header.append('{0}({1})'.format(name, args_list))
+    fn_header.append(name + '(' + args_list + ')')
 
     #Templated constructors are marked as TEMPLATE_FUNCTION not CONSTRUCTOR.
     #They are rare but we should still detect them manually.
-    if fn_cursor.kind != CursorKind.CONSTRUCTOR and \
-            fn_cursor.kind != CursorKind.DESTRUCTOR and \
+    if fn_cursor.kind not in _structor_kinds and \
             name != fn_cursor.semantic_parent.spelling:
         fn_header.appendleft(format_type_name(return_type)  + ' ')
 
@@ -458,23 +632,45 @@ def make_function_header(fn_cursor, inline=False, namespace='',
 
     return ''.join(fn_header)
 
-def find_defined_functions(tu, file, target_fn):
-    '''Return a dictionary of functions defined in the same scope
-       as target_fn. The dictionary has keys containing the names
-       of each functions and values that are lists of all overloads
-       of the function with that name.'''
-    traverser = DefinitionTraverser(file, target_fn)
-    fn_dict = traverser.traverse(tu.cursor)
-    return fn_dict
+def find_stub_context(tu, target_fn, files, scope_cache=None):
+    '''Return a tuple of (definitions, following declarations,
+       lexical namespaces) for target_fn, gathered in a single
+       traversal of tu. definitions is a dictionary keyed by function
+       name whose values are lists of all overloads defined in the
+       output file.
+       The traversal results only depend on the semantic and lexical
+       parents of target_fn, so if a scope_cache dict is given they are
+       stored in it and later functions in the same scope skip the
+       traversal.'''
+    scope = (get_canonical_hash(target_fn.semantic_parent), \
+            get_canonical_hash(target_fn.lexical_parent))
+    if scope_cache is not None and scope in scope_cache:
+        definitions, siblings, lexical_namespaces = scope_cache[scope]
+    else:
+        definitions, siblings, lexical_namespaces = traverse_stub_context( \
+                tu.cursor, files.output, files.header, target_fn)
+        if scope_cache is not None:
+            scope_cache[scope] = (definitions, siblings, lexical_namespaces)
+    decl_list = get_following_declarations(siblings, target_fn)
+    return (definitions, decl_list, lexical_namespaces)
+
+def get_following_declarations(siblings, fn_cursor):
+    '''Get the function declarations in siblings, the declarations
+       sharing the lexical scope of fn_cursor, that come after it.'''
+    fn_hash = get_canonical_hash(fn_cursor)
+    for i, cursor in enumerate(siblings):
+        if get_canonical_hash(cursor) == fn_hash:
+            return siblings[i+1:]
+    return []
 
 def get_definition_for_function(definitions, cursor):
     '''Find the definition for function cursor in definitions if
        it exists.'''
     name = cursor.spelling
     if name in definitions:
-        cur_list = definitions[name]
-        for cur in cur_list:
-            if cur.canonical == cursor.canonical:
+        cursor_hash = get_canonical_hash(cursor)
+        for cur in definitions[name]:
+            if get_canonical_hash(cur) == cursor_hash:
                 return cur
     return None
 
@@ -491,33 +687,15 @@ def find_closest_function_definition(tu, target_fn, fn_list, definitions):
 
 def get_namespaces(cursor):
     '''Return a list of all namespaces cursor belongs to'''
-    namespaces = []
-    cur = cursor
-    while cur is not None:
-        if cur.kind == CursorKind.NAMESPACE:
-            namespaces.append(cur)
-        cur = cur.semantic_parent
+    namespace_kind = CursorKind.NAMESPACE
+    namespaces = [cur for cur in get_semantic_parents(cursor) \
+            if cur.kind == namespace_kind]
+    if cursor.kind == namespace_kind:
+        namespaces.insert(0, cursor)
     return namespaces[::-1]
 
-def get_lexical_namespaces(tu, cursor, source_file):
-    '''Return a list of all namespaces cursor is enclosed by
-       within the file source_file'''
-    traverser = NamespaceTraverser(source_file, cursor)
-    namespace_list = traverser.traverse(tu.cursor)
-    return namespace_list
-
-
-def get_following_declarations(header_file, fn_cursor):
-    '''Get all function declarations in the same scope but below
-       fn_cursor.'''
-    traverser = FollowingFunctionTraverser(header_file, fn_cursor)
-    return traverser.traverse(fn_cursor.semantic_parent)
-
-
 def get_output_location(tu, fn_cursor, files, above_def, namespaces):
     '''Return the line at which to insert the function definition'''
-    parent = fn_cursor.semantic_parent
-
     line = 0
 
     #Try to put the new function above the function below it in the header
@@ -547,7 +725,8 @@ def build_namespace_scope_resolution(namespaces, lexical_namespaces):
     for i in range(0, len(lexical_namespaces)):
         if i >= len(namespaces):
             break
-        if namespaces[i].canonical == lexical_namespaces[i].canonical:
+        if get_canonical_hash(namespaces[i]) == \
+                get_canonical_hash(lexical_namespaces[i]):
             lexical_depth += 1
         else:
             break
@@ -576,23 +755,82 @@ def generate_method_stub(tu, cursor, files, lexical_namespaces):
 
     return fn_string
 
-def write_method(fn_string, buffer, line, above_endif=False):
-    '''Write the function definition in fn_string to buffer
-       at the line line and jump to the middle of the definition'''
+def find_endif_line(buffer):
+    '''Return the index of the last #endif line in buffer, or None
+       if there is none. The result is cached until the buffer is
+       changed other than through insert_lines.'''
+    tick = get_changedtick(buffer)
+    cached = _endif_line_cache.get(buffer.number)
+    if cached is not None and cached[0] == tick:
+        return cached[1]
+
+    endif_line = None
+    for i in range(len(buffer) - 1, 1, -1):
+        if buffer[i].find('#endif') >= 0:
+            endif_line = i
+            break
+    _endif_line_cache[buffer.number] = (tick, endif_line)
+    return endif_line
+
+def get_write_line(buffer, line, above_endif=False):
+    '''Return the line of buffer to write a definition at for the
+       output location line, where -1 means the end of the file'''
     if line <= 0:
         #For headers, we need to manually search for #endif at the bottom
         line = len(buffer)
         if above_endif:
-            for i in range(len(buffer) - 1, 1, -1):
-                if buffer[i].find('#endif') >= 0:
-                    line = i
-                    break
+            endif_line = find_endif_line(buffer)
+            if endif_line is not None:
+                line = endif_line
+    return line
+
+def insert_lines(buffer, line, lines):
+    '''Insert lines into buffer before line, keeping the cached
+       #endif position up to date.'''
+    cached = _endif_line_cache.get(buffer.number)
+    if cached is not None and cached[0] != get_changedtick(buffer):
+        cached = None
+
+    if line == len(buffer):
+        buffer.append(lines)
+    else:
+        buffer[line:line] = lines
 
+    if cached is not None:
+        endif_line = cached[1]
+        if endif_line is not None and line <= endif_line:
+            endif_line += len(lines)
+        _endif_line_cache[buffer.number] = \
+                (get_changedtick(buffer), endif_line)
+
+def write_method(fn_string, buffer, line, above_endif=False):
+    '''Write the function definition in fn_string to buffer
+       at the line line and jump to the middle of the definition'''
+    line = get_write_line(buffer, line, above_endif)
     lines = fn_string.split('\n')
-    buffer[line:line] = lines
+    insert_lines(buffer, line, lines)
     command = 'normal! {0}G'.format(line + len(lines) - 2)
     vim.command(command)
 
+def write_methods(insertions, buffer, above_endif=False):
+    '''Write several function definitions to buffer in one pass.
+       insertions maps each output location to the list of definitions
+       to write there, in order. Jumps to the middle of the first
+       definition in the buffer.'''
+    edits = {}
+    for line, fn_strings in insertions.items():
+        line = get_write_line(buffer, line, above_endif)
+        edits.setdefault(line, []).extend(fn_strings)
+
+    #Write from the bottom up so earlier lines are not shifted
+    jump_line = None
+    for line in sorted(edits, reverse=True):
+        fn_strings = edits[line]
+        insert_lines(buffer, line, '\n'.join(fn_strings).split('\n'))
+        jump_line = line + len(fn_strings[0].split('\n')) - 2
+    if jump_line is not None:
+        vim.command('normal! {0}G'.format(jump_line))
+
 def source_location_from_position(tu, file_name, line, col):
     '''Return a clang SourceLocation object for the given location'''
     file = clang.cindex.File.from_name(tu, file_name)
@@ -603,23 +841,29 @@ def find_fn_name_from_line(str):
     '''Try to find the last character of the function name
        on the line provided. This position can be used to get the
        function cursor for the line.'''
-    i = len(str) - 1
+    #Nothing to find on lines without parentheses, which are most of
+    #the lines in a range
+    if '(' not in str and ')' not in str:
+        return None
     depth = 0
     found_one = False
-    while i >= 0:
-        if str[i] == ')':
+    last = len(str) - 1
+    #Only brackets change the state, so jump between them from the end by
+    #scanning the reversed line, stopping as soon as the name is found
+    for match in _bracket_re.finditer(str[::-1]):
+        ch = match.group()
+        if ch == ')':
             found_one = True
             depth += 1
-        elif str[i] == '(':
+        elif ch == '(':
             found_one = True
             depth -= 1
-        elif str[i] == '}':
+        elif ch == '}':
             depth += 1
-        elif str[i] == '{':
+        else:
             depth -= 1
         if depth == 0 and found_one:
-            return i - 1
-        i -= 1
+            return last - match.start() - 1
     return None
 
 def get_function_cursor_on_line(tu, location, buffer):
@@ -645,10 +889,25 @@ def build_unsaved_data(files):
         if file:
             buf = get_buffer_with_name(file)
             if buf is not None:
-                unsaved_data.append((file, '\n'.join(buf)))
+                unsaved_data.append((file, get_buffer_text(buf)))
 
     return unsaved_data
 
+def get_changedtick(buf):
+    '''Return the b:changedtick of buf.'''
+    return vim.eval('getbufvar({0}, "changedtick")'.format(buf.number))
+
+def get_buffer_text(buf):
+    '''Return the contents of buf as a single string, reusing the
+       previous result while the buffer's changedtick is unchanged.'''
+    tick = get_changedtick(buf)
+    cached = _buffer_text_cache.get(buf.number)
+    if cached is not None and cached[0] == tick:
+        return cached[1]
+    text = '\n'.join(buf)
+    _buffer_text_cache[buf.number] = (tick, text)
+    return text
+
 def open_output_buffer(file_name):
     buffer = get_buffer_with_name(file_name)
     if buffer is not vim.current.buffer:
@@ -658,46 +917,44 @@ def open_output_buffer(file_name):
             vim.command('b! {0}'.format(file_name))
     return vim.current.buffer
 
-def generate_over_range(index, files, start_line, end_line, force=False):
+def generate_over_range(files, start_line, end_line, force=False):
     '''Generate declarations for all functions on lines between start_line
-       and end_line'''
+       and end_line. Every definition is generated against the same parse
+       before any of them are written to the output buffer.'''
     in_buf = get_buffer_with_name(files.input)
     unsaved_data = build_unsaved_data([files.header, files.source])
-    tu = create_translation_unit(index, files.output, unsaved_data)
-    tracker = InsertionTracker()
+    tu = get_translation_unit(files, unsaved_data)
+    scope_cache = get_scope_cache(files)
 
-    buffer = open_output_buffer(files.output)
-    start_len = len(buffer)
+    insertions = {}
+    seen = set()
     for line in range(start_line, end_line+1):
         location = source_location_from_position(tu, files.input, line, 1)
         cursor = get_function_cursor_on_line(tu, location, in_buf)
+        if cursor is None:
+            continue
+
+        #Declarations spanning several lines are only generated once
+        fn_hash = get_canonical_hash(cursor)
+        if fn_hash in seen:
+            continue
+        seen.add(fn_hash)
+
+        definitions, decl_list, lexical_namespaces = \
+                find_stub_context(tu, cursor, files, scope_cache)
+        definition = get_definition_for_function(definitions, cursor)
+        if definition is not None and not force:
+            continue
+
+        next_def = find_closest_function_definition(tu, cursor, \
+                decl_list, definitions)
+        insert_line = get_output_location(tu, cursor, files, \
+                next_def, lexical_namespaces)
+        body = generate_method_stub(tu, cursor, files, lexical_namespaces)
+        insertions.setdefault(insert_line, []).append(body)
 
-        out_line = None
-        insert_line = None
-        if cursor:
-            definitions = find_defined_functions(tu, files.output, cursor)
-            definition = get_definition_for_function(definitions, cursor)
-            if definition is not None and not force:
-                continue
-            
-            decl_list = get_following_declarations(files.header, cursor)
-            next_def = find_closest_function_definition(tu, cursor, \
-                    decl_list, definitions)
-
-            lexical_namespaces = get_lexical_namespaces(tu, cursor, files.output)
-            if next_def is not None and next_def.displayname in tracker:
-                out_line = tracker.get_block_line_number(next_def.displayname)
-                insert_line = tracker.get_block_insertion_line(next_def.displayname)
-            else:
-
-                insert_line = get_output_location(tu, cursor, files, \
-                        next_def, lexical_namespaces)
-                if insert_line == -1:
-                    insert_line = - 1
-                out_line = tracker.map_line_number(insert_line)
-            body = generate_method_stub(tu, cursor, files, lexical_namespaces)
-            tracker.insert_block(insert_line, cursor.displayname, len(body.split('\n')))
-            write_method(body, buffer, out_line, files.is_output_header)
+    buffer = open_output_buffer(files.output)
+    write_methods(insertions, buffer, files.is_output_header())
 
 def generate_at_location(tu, files, line, col, force=False):
     '''Generate a declaration for the provided line'''
@@ -708,7 +965,8 @@ def generate_at_location(tu, files, line, col, force=False):
         error('Unable to find a function at the location specified')
         return
 
-    definitions = find_defined_functions(tu, files.output, cursor)
+    definitions, decl_list, lexical_namespaces = \
+            find_stub_context(tu, cursor, files, get_scope_cache(files))
     definition = get_definition_for_function(definitions, cursor)
 
     if definition and not force:
@@ -719,17 +977,24 @@ def generate_at_location(tu, files, line, col, force=False):
 
     buffer = open_output_buffer(files.output)
 
-    decl_list = get_following_declarations(files.header, cursor)
     next_def = find_closest_function_definition(tu, cursor, \
             decl_list, definitions)
 
-    lexical_namespaces = get_lexical_namespaces(tu, cursor, files.output)
     body = generate_method_stub(tu, cursor, files, lexical_namespaces)
     line = get_output_location(tu, cursor, files, next_def, lexical_namespaces)
     write_method(body, buffer, line, files.is_output_header())
 
 def make_fileset_for_source(source_file, force_inline):
+    '''Return the FileSet for source_file. Results are cached per
+       path until invalidate_fileset_cache is called for it. A FileSet
+       missing its header or source is looked up again every time, since
+       the counterpart may have been created since.'''
     file_name = os.path.abspath(source_file)
+    key = (file_name, force_inline)
+    files = _fileset_cache.get(key)
+    if files is not None and files.header and files.source:
+        return files
+
     header_file = get_header_file(file_name)
     source_file = get_source_file(file_name)
 
@@ -739,8 +1004,22 @@ def make_fileset_for_source(source_file, force_inline):
         parse_file = header_file
 
     files = FileSet(source_file, header_file, file_name, parse_file)
+    _fileset_cache[key] = files
     return files
 
+def invalidate_fileset_cache(path):
+    '''Drop cached FileSets for files sharing a base name with path,
+       along with any whose header or source no longer exists.'''
+    base = os.path.splitext(os.path.abspath(path))[0]
+    for key, files in list(_fileset_cache.items()):
+        stale = os.path.splitext(files.input)[0] == base
+        for file in [files.header, files.source]:
+            if file and not os.path.exists(file) and \
+                    get_buffer_with_name(file) is None:
+                stale = True
+        if stale:
+            del _fileset_cache[key]
+
 
 def generate_under_cursor(force_inline=False, force_generation=False):
     '''Entry point from vim. Get the position of the cursor
@@ -752,8 +1031,7 @@ def generate_under_cursor(force_inline=False, force_generation=False):
 
     unsaved_data = build_unsaved_data([files.header, files.source])
 
-    index = clang.cindex.Index.create()
-    tu = create_translation_unit(index, files.output, unsaved_data)
+    tu = get_translation_unit(files, unsaved_data)
 
     _, line, col, _ = vim.eval("getpos('.')")
     line = int(line)
@@ -766,5 +1044,4 @@ def generate_range(start_line, end_line, force_inline=False, \
 
     files = make_fileset_for_source(file_name, force_inline)
 
-    index = clang.cindex.Index.create()
-
+    generate_over_range(files, start_line, end_line, force_generation)
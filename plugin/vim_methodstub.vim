@@ -8,6 +8,12 @@ function! s:ClassTemplateInit()
         execute 'python sys.path.append("' . s:plugin_path . '")'
         execute 'python from methodstub import methodstub'
         execute 'python from methodstub import accessor'
+        augroup methodstub_fileset
+            au!
+            au BufAdd,BufFilePost,BufWipeout * python methodstub.invalidate_buffer_index()
+            au BufWritePost,BufDelete,BufAdd,BufNew,BufFilePost * call <SID>InvalidateFileSet(expand('<afile>:p'))
+            au BufDelete,BufWipeout * call <SID>ForgetTranslationUnits(expand('<afile>:p'))
+        augroup END
         let s:methodstub_plugin_loaded = 1
     endif
     command! -buffer -nargs=* GenFnStub python methodstub.generate_under_cursor(<f-args>)
@@ -18,3 +24,11 @@ endfunction
 function! s:GenFnStubRange(inline) range abort
     execute 'python methodstub.generate_range(' . a:firstline . ', ' . a:lastline . ', ' . a:inline . ')'
 endfunction
+
+function! s:InvalidateFileSet(path)
+    execute 'python methodstub.invalidate_fileset_cache("' . escape(a:path, '\"') . '")'
+endfunction
+
+function! s:ForgetTranslationUnits(path)
+    execute 'python methodstub.forget_translation_units("' . escape(a:path, '\"') . '")'
+endfunction